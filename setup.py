@@ -43,7 +43,10 @@ setuptools.setup(
         "scikit-image",
         "scikit-learn",
         "natsort",
-        "pandas"
+        "pandas>=2.2",
+        "lxml",
+        "numba",
+        "python-calamine"
     ],
 
     extras_require = {
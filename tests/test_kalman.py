@@ -0,0 +1,78 @@
+from unittest import TestCase
+
+import cv2 as cv
+import numpy as np
+
+from xmot.mot.kalman import MOT, _F, _H, _Q, _R
+from xmot.mot.kalman_kernels import correct_states
+from xmot.mot.utils import state_from_mask
+
+
+def cv_kalman(state):
+    """A cv.KalmanFilter set up as the filters of MOT, starting from STATE."""
+    kalm = cv.KalmanFilter(8, 4, 0)
+    kalm.transitionMatrix = _F.copy()
+    kalm.measurementMatrix = _H.copy()
+    kalm.processNoiseCov = _Q.copy()
+    kalm.measurementNoiseCov = _R.copy()
+    kalm.statePost = np.array(list(state) + [0, 0, 0, 0], dtype=np.float32).reshape(8, 1)
+    kalm.errorCovPost = np.zeros((8, 8), dtype=np.float32)
+    return kalm
+
+
+def square_mask(x, y, size, height=100, width=100):
+    mask = np.zeros((1, height, width), dtype=bool)
+    mask[0, y:y + size, x:x + size] = True
+    return mask
+
+
+class Test(TestCase):
+    def test_correct_states(self):
+        rng = np.random.default_rng(0)
+        n_blobs = 5
+        kalms = [cv_kalman(rng.uniform(0, 100, 4)) for _ in range(n_blobs)]
+        for kalm in kalms:
+            kalm.predict()
+        X = np.array([np.squeeze(kalm.statePre) for kalm in kalms], dtype=np.float32)
+        P = np.array([kalm.errorCovPre for kalm in kalms], dtype=np.float32)
+
+        # Correct only some of the blobs, in a different order than their rows.
+        inds = np.array([3, 0, 4], dtype=np.intp)
+        Z = rng.uniform(0, 100, (len(inds), 4)).astype(np.float32)
+        correct_states(X, P, inds, Z, _H, _R)
+        for k, i in enumerate(inds):
+            kalms[i].correct(Z[k].reshape(4, 1))
+
+        for i, kalm in enumerate(kalms):
+            expected_state = np.squeeze(kalm.statePost if i in inds else kalm.statePre)
+            expected_cov = kalm.errorCovPost if i in inds else kalm.errorCovPre
+            np.testing.assert_allclose(X[i], expected_state, rtol=1e-5, atol=1e-4)
+            np.testing.assert_allclose(P[i], expected_cov, rtol=1e-5, atol=1e-4)
+
+    def test_mot_matches_cv_kalman(self):
+        # One particle moving with a constant velocity and one appearing later.
+        mask = [square_mask(10, 20, 8)]
+        states = [list(state_from_mask(m)) for m in mask]
+        mot = MOT(states, np.array(mask))
+        kalm = cv_kalman(states[0])
+
+        for frame in range(1, 8):
+            mask = [square_mask(10 + 3 * frame, 20 + 2 * frame, 8)]
+            if frame >= 4:
+                mask.append(square_mask(70, 70, 6))
+            states = [list(state_from_mask(m)) for m in mask]
+            mot.step(states, np.array(mask))
+
+            kalm.predict()
+            kalm.correct(np.array(states[0], dtype=np.float32).reshape(4, 1))
+
+            self.assertEqual(len(mot.blobs), len(mask))
+            np.testing.assert_allclose(mot.X[0], np.squeeze(kalm.statePost), rtol=1e-5, atol=1e-4)
+            np.testing.assert_allclose(mot.P[0], kalm.errorCovPost, rtol=1e-5, atol=1e-4)
+            np.testing.assert_allclose(mot.blobs[0].state, mot.X[0, :4])
+
+        # Without a detection, the blob only takes the batched prediction.
+        mot.step([], np.zeros((0, 100, 100), dtype=bool))
+        kalm.predict()
+        np.testing.assert_allclose(mot.X[0], np.squeeze(kalm.statePre), rtol=1e-5, atol=1e-4)
+        np.testing.assert_allclose(mot.P[0], kalm.errorCovPre, rtol=1e-5, atol=1e-4)
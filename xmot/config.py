@@ -3,5 +3,5 @@ A common place to collect constants that are used across the library.
 """
 
 IMAGE_FORMAT = ["jpg", "png", "tif", "tiff", "jpeg"]
-IMAGE_FILE_PATTERN = ".*_([0-9]+)_([a-zA-Z]*)([0-9]+)\.([a-zA-Z]+)"
+IMAGE_FILE_PATTERN = r".*_([0-9]+)_([a-zA-Z]*)([0-9]+)\.([a-zA-Z]+)"
 AREA_THRESHOLD = 100
\ No newline at end of file
@@ -1,9 +1,10 @@
 from typing import List, Tuple
 import pandas as pd
 import re
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 import numpy as np
 import json
+import io
 
 from xmot.logger import Logger
 from xmot.digraph.particle import Particle
@@ -15,81 +16,100 @@ from xmot import config
 Parser of xmot.digraph.particle in different formats.
 """
 
+_IMAGE_FILE_RE = re.compile(config.IMAGE_FILE_PATTERN)
+
 def load_blobs_from_excel(file_name: str) -> List[Particle]:
     """ A temporary io function to load data from Kerri-Lee's excel data.
 
     The function assumes a specific format of the excel data, and will be replaced by more
     general format later.
     """
-    data_id = pd.read_excel(file_name, sheet_name="Particle ID", engine="openpyxl")
-    data_pos = pd.read_excel(file_name, sheet_name="Raw_data", engine="openpyxl")
+    # Open the workbook once and read both sheets from it. The calamine engine parses xlsx
+    # files much faster than openpyxl.
+    with pd.ExcelFile(file_name, engine="calamine") as xlsx:
+        data_id = xlsx.parse(sheet_name="Particle ID")
+        data_pos = xlsx.parse(sheet_name="Raw_data")
 
     # remove N/A
     data_id = data_id.fillna(0).astype(int)
 
-    particles = []
-    for i in range(0, len(data_id)):
-        row_id = data_id.loc[i]
-        row_pos = data_pos.loc[i]
-
-        row_id = row_id[row_id.gt(0)]
-        if len(row_id) <= 1:
-            # Has only "Act_frame" column and no ided particle in this frame.
-            continue
+    # Gather every ided particle of every frame at once rather than walking the rows.
+    frames = data_id["Act_frame"].to_numpy()
+    ids = data_id.drop(columns="Act_frame").to_numpy()
+    rows, cols = np.nonzero(ids > 0)
+    pids = ids[rows, cols]
+    # The x and y of particle ID are in the (2 * ID)-th and (2 * ID + 1)-th columns.
+    pos = data_pos.to_numpy()[rows[:, np.newaxis], np.stack([2 * pids, 2 * pids + 1], axis=1)]
 
-        time_frame = row_id["Act_frame"]
-        # Iterate all particles ided in this frame
-        for j in range(1, len(row_id)):
-            id = row_id[j]
-            pos = [row_pos[2 * id], row_pos[2 * id + 1]]
-            # Has no bubble info and predicted positions for now.
-            particles.append(Particle(id, time_frame, pos))
+    # Has no bubble info, bbox and predicted positions for now.
+    particles = [Particle(p.tolist(), [0, 0], id=id, time_frame=frame)
+                 for id, frame, p in zip(pids.tolist(), frames[rows].tolist(), pos)]
 
     return particles
 
 def load_blobs_from_text(file_name: str, img_height=commons.PIC_DIMENSION[0], img_width=commons.PIC_DIMENSION[1]) -> List[Particle]:
-    particles = []
+    """
+    Load particles from the text file written by xmot.mot.utils.writeBlobs(), one particle per
+    line: centroid_x; centroid_y; width; height; id; frame_id; contour in JSON.
+    """
+    columns = ["centroid_x", "centroid_y", "width", "height", "id", "frame_id", "contour"]
     with open(file_name, "r") as f:
-        for line in f:
-            terms = line.split(";")
-            terms = [term.strip() for term in terms]
-            if len(terms) != 7:
-                Logger.warning("Invalid blob info: {:s}".format(line))
-            else:
-                #x1, y1, x2, y2, width, height, id, time_frame = terms
-                # The centroid_x, centroid_y could be negative, according to Kalman filter's prediction
-                centroid_x, centroid_y, width, height, id, frame_id = [int(term) for term in terms[0:6]]
-                contour = np.array(json.loads(terms[6]), dtype=np.float32)
-                if len(contour) == 0:
-                    contour = None
-                ## Sanity check. During Kalman filter, the coordinates of the bbox might be out of
-                ## the image. We need to check them before adding this particle into digraph.
-                #if (x1 < 0 and x2 < 0) or \
-                #        (x1 > img_width and x2 > img_width) or \
-                #        (y1 < 0 and y2 < 0) or \
-                #        (y1 > img_height and y2 > img_height):
-                #    Logger.debug("Invalid particle. Coordinates outside the image. {:d} {:d} {:d} {:d}".format(x1, y1, x2, y2))
-                #    continue  # Skip this particle. Invalid.
-
-                #x1_new = x1 if x1 >= 0 else 0
-                #y1_new = y1 if y1 >= 0 else 0
-                #x2_new = x2 if x2 < img_width else img_width
-                #y2_new = y2 if y2 < img_height else img_height
-
-                #width_new = x2_new - x1_new
-                #height_new = y2_new - y1_new
-
-                ## If after adjustment, the particle doesn't have a valid size, discard it.
-                #if width_new <=0 or height_new <=0:
-                #    Logger.debug("Invalid particle. Non-positive width or height. {:d} {:d} {:d} {:d}".format(x1, y1, x2, y2))
-                #    continue
-                #particles.append(Particle([x1_new, y1_new], bbox=[width_new, height_new], id=id, time_frame=time_frame))
-                particles.append(
-                    Particle(
-                        [centroid_x, centroid_y], bbox=[width, height], id=id, time_frame=frame_id,
-                        contour=contour
-                    )
-                )
+        lines = f.read().splitlines()
+
+    # Drop lines without exactly 7 fields before handing the rest to pandas. The contour in JSON
+    # doesn't contain ";", so counting separators is enough.
+    valid_lines = []
+    for line in lines:
+        if line.count(";") != len(columns) - 1:
+            Logger.warning("Invalid blob info: {:s}".format(line))
+        else:
+            valid_lines.append(line)
+    if len(valid_lines) == 0:
+        return []
+
+    # The first six fields are integers and parsed in bulk.
+    data = pd.read_csv(io.StringIO("\n".join(valid_lines)), sep=";", header=None, names=columns,
+                       index_col=False, skipinitialspace=True, engine="c")
+
+    invalid = data.isna().any(axis=1).to_numpy()
+    for i in np.flatnonzero(invalid):
+        Logger.warning("Invalid blob info: {:s}".format(valid_lines[i]))
+    data = data[~invalid]
+
+    #x1, y1, x2, y2, width, height, id, time_frame = terms
+    # The centroid_x, centroid_y could be negative, according to Kalman filter's prediction
+    ints = data[columns[:6]].to_numpy(dtype=np.int64).tolist()
+    contours = [np.array(json.loads(contour), dtype=np.float32) for contour in data["contour"]]
+
+    ## Sanity check. During Kalman filter, the coordinates of the bbox might be out of
+    ## the image. We need to check them before adding this particle into digraph.
+    #if (x1 < 0 and x2 < 0) or \
+    #        (x1 > img_width and x2 > img_width) or \
+    #        (y1 < 0 and y2 < 0) or \
+    #        (y1 > img_height and y2 > img_height):
+    #    Logger.debug("Invalid particle. Coordinates outside the image. {:d} {:d} {:d} {:d}".format(x1, y1, x2, y2))
+    #    continue  # Skip this particle. Invalid.
+
+    #x1_new = x1 if x1 >= 0 else 0
+    #y1_new = y1 if y1 >= 0 else 0
+    #x2_new = x2 if x2 < img_width else img_width
+    #y2_new = y2 if y2 < img_height else img_height
+
+    #width_new = x2_new - x1_new
+    #height_new = y2_new - y1_new
+
+    ## If after adjustment, the particle doesn't have a valid size, discard it.
+    #if width_new <=0 or height_new <=0:
+    #    Logger.debug("Invalid particle. Non-positive width or height. {:d} {:d} {:d} {:d}".format(x1, y1, x2, y2))
+    #    continue
+    #particles.append(Particle([x1_new, y1_new], bbox=[width_new, height_new], id=id, time_frame=time_frame))
+    particles = [
+        Particle(
+            [centroid_x, centroid_y], bbox=[width, height], id=id, time_frame=frame_id,
+            contour=contour if len(contour) != 0 else None
+        )
+        for (centroid_x, centroid_y, width, height, id, frame_id), contour in zip(ints, contours)
+    ]
     return particles
 
 def parse_pascal_xml(file_path: str, area_threshold=config.AREA_THRESHOLD) -> Tuple[List[Particle], str]:
@@ -109,39 +129,50 @@ def parse_pascal_xml(file_path: str, area_threshold=config.AREA_THRESHOLD) -> Tu
         List[Particle]: List of particles parsed from FILE.
         str: the file name of the image.
     """
-    doc = ET.parse(file_path)
-    file_name = doc.find("filename").text # Only the file name of the corresponding image.
+    file_name = None # Only the file name of the corresponding image.
     particles = []
-    for obj in doc.findall("object"): # Only find direct child of doc.
-        properties = obj.find("name").text.split("_") # label
-        p_type=properties[0]
-        p_shape=""
-        p_bubble=None
-        if p_type == "particle":
-            p_shape = properties[2]
-            if properties[1] == "bubble":
-                p_bubble = Particle([0,0], [1,1]) # Dummy object.
-        elif p_type == "shell":
-            p_shape = properties[1]
-            p_bubble = Particle([0, 0], [1, 1]) # Dummy object. A shell must have bubble.
-        elif p_type == "agglomerate":
-            p_shape = "non-circle"
-            p_bubble = None
-        p_bbox = obj.find("bndbox")
-        xmin = int(p_bbox.find("xmin").text)
-        ymin = int(p_bbox.find("ymin").text)
-        xmax = int(p_bbox.find("xmax").text)
-        ymax = int(p_bbox.find("ymax").text)
-        bbox = [xmin, ymin, xmax, ymax]
-        if areaBbox(bbox) <= area_threshold:
+    # Stream the document and handle each object as soon as it is closed. Handled elements are
+    # cleared and detached from the root, so only the object being parsed is kept in memory.
+    for _event, elem in ET.iterparse(file_path, events=("end",), tag=("filename", "object")):
+        if elem.tag == "filename":
+            file_name = elem.text
+            bbox = None
+        else:
+            properties = elem.findtext("name").split("_") # label
+            p_type=properties[0]
+            p_shape=""
+            p_bubble=None
+            if p_type == "particle":
+                p_shape = properties[2]
+                if properties[1] == "bubble":
+                    p_bubble = Particle([0,0], [1,1]) # Dummy object.
+            elif p_type == "shell":
+                p_shape = properties[1]
+                p_bubble = Particle([0, 0], [1, 1]) # Dummy object. A shell must have bubble.
+            elif p_type == "agglomerate":
+                p_shape = "non-circle"
+                p_bubble = None
+            xmin = int(elem.findtext("bndbox/xmin"))
+            ymin = int(elem.findtext("bndbox/ymin"))
+            xmax = int(elem.findtext("bndbox/xmax"))
+            ymax = int(elem.findtext("bndbox/ymax"))
+            bbox = [xmin, ymin, xmax, ymax]
+
+        # Release this element and the preceding siblings (e.g. <folder>, <size> and the objects
+        # already parsed) once their fields are extracted.
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+        if bbox is None or areaBbox(bbox) <= area_threshold:
             continue
         p = Particle(position=[xmin, ymin], bbox=[xmax - xmin, ymax - ymin],
                      type=p_type, shape=p_shape, bubble=p_bubble)
         particles.append(p)
 
     # sort in ascending order of y (row-index of numpy), and then x (column-index of numpy).
-    particles.sort(key=lambda p: list(reversed(p.get_position())))
-    obj = re.match(".*_([0-9]+)_([a-zA-Z]*)([0-9]+)\.([a-zA-Z]+)", file_name)
+    particles.sort(key=lambda p: (p.position[1], p.position[0]))
+    obj = _IMAGE_FILE_RE.match(file_name)
     if obj is None:
         print(f"Cannot read video and image id from picture {file_name}")
     else:
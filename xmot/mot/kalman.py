@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-Kalman class using opencv implementation
+Kalman class tracking all blobs with linear Kalman filters
 """
 
 import cv2 as cv
@@ -8,20 +8,47 @@ import numpy as np
 from typing import List, Any
 from scipy.optimize import linear_sum_assignment
 from xmot.mot.utils import cen2cor, cor2cen, costMatrix, unionBlob, iom, mask_to_cnt, cnt_to_mask
+from xmot.mot.kalman_kernels import correct_states
 from xmot.logger import Logger
 
+# Matrices of the linear Kalman filter, shared by all blobs and trackers.
+# transition matrix
+_F = np.array([[1, 0, 0, 0, 1, 0, 0, 0], # centroid x of the contour
+               [0, 1, 0, 0, 0, 1, 0, 0], # centroid y of the contour
+               [0, 0, 1, 0, 0, 0, 1, 0], # w
+               [0, 0, 0, 1, 0, 0, 0, 1], # h
+               [0, 0, 0, 0, 1, 0, 0, 0], # v_centroid_x
+               [0, 0, 0, 0, 0, 1, 0, 0], # v_centroid_y
+               [0, 0, 0, 0, 0, 0, 1, 0], # w_dot
+               [0, 0, 0, 0, 0, 0, 0, 1]  # h_dot
+               ], dtype=np.float32)
+
+# measurement matrix
+# Can only measure center_x, center_y, w, h. Therefore, first dimension is 4.
+_H = np.eye(4, 8, dtype=np.float32)
+
+# process noise covariance
+_Q = 4.*np.eye(8, dtype=np.float32)
+
+# measurement noise covariance
+_R = 4.*np.eye(4, dtype=np.float32)
+
 class Blob:
     """
     Abstraction of identified particles in video, (i.e. unqiue particle).
 
+    The Kalman filter of the blob is owned by MOT (rows of MOT.X and MOT.P). The blob only keeps
+    a copy of the latest filtered state, refreshed by MOT at each frame.
+
     Attributes:
         idx:    integer:    Particle ID, starting from 1.
-        state:  List[int]:  [centroid_x, centroid_y, width, height]: centroid coordinates and dimension of bbox
-                            of the particle contour
+        state:  np.ndarray: (4,) float32 [centroid_x, centroid_y, width, height]: centroid coordinates
+                            and dimension of bbox of the particle contour, as predicted or corrected by
+                            the Kalman filter. It is the detected state (List[int]) until the first
+                            prediction.
         color:  List[int]:  [x, y, z] RGB color code of the particle.
         dead:   int:        Number of consecutive frames the particle has not been detected.
         frames: List[int]:  List of frame IDs that the particle are considered existing.
-        kalm:   KalmanFilter: The kalmanfilter object tracking this particle.
         masks:  Dict[int, np.ndarray]: List of masks with dimension (1, img_height, img_width) of the
                                        particle at each frame. For frames this particle is not detected
                                        yet alive, there is an empty array as a place holder.
@@ -36,58 +63,30 @@ class Blob:
         #self.bbox   = bbox
         self.state = state
         self.masks  = {frame_id: mask}
-        self.color  = np.random.randint(0,255,size=(3,))
+        self._color = None
         self.dead   = 0
         self.frames = [frame_id]
         self.contours = {frame_id: mask_to_cnt(mask)[0]} # The first element of the return tuple is the contour.
 
-        # Kalman object
-        self.kalm  = cv.KalmanFilter(8, 4, 0)
-
-        # transition matrix
-        F = np.array([[1, 0, 0, 0, 1, 0, 0, 0], # centroid x of the contour
-                      [0, 1, 0, 0, 0, 1, 0, 0], # centroid y of the contour
-                      [0, 0, 1, 0, 0, 0, 1, 0], # w
-                      [0, 0, 0, 1, 0, 0, 0, 1], # h
-                      [0, 0, 0, 0, 1, 0, 0, 0], # v_centroid_x
-                      [0, 0, 0, 0, 0, 1, 0, 0], # v_centroid_y
-                      [0, 0, 0, 0, 0, 0, 1, 0], # w_dot
-                      [0, 0, 0, 0, 0, 0, 0, 1]  # h_dot
-                      ], dtype=np.float32)
-
-        self.kalm.transitionMatrix = F
-
-        # measurement matrix
-        # Can only measure center_x, center_y, w, h. Therefore, first dimension is 4.
-        self.kalm.measurementMatrix = np.eye(4, 8, dtype=np.float32)
+    @property
+    def color(self):
+        # Only drawn when the blob is visualized, rather than for every new blob.
+        if self._color is None:
+            self._color = np.random.randint(0,255,size=(3,))
+        return self._color
 
-        # process noise covariance
-        self.kalm.processNoiseCov = 4.*np.eye(8, dtype=np.float32)
+    def correct(self, frame_id: int, state: np.ndarray[np.float32], mask: np.ndarray[Any, np.dtype[np.bool_]]):
+        """Record the state corrected by the Kalman filter and the mask of a new frame.
 
-        # measurement noise covariance
-        self.kalm.measurementNoiseCov = 4.*np.eye(4, dtype=np.float32)
-
-        # Set posterior state
-        #state = list(cor2cen(self.bbox)) + [0, 0, 0, 0]
-        _state = self.state + [0, 0, 0, 0]
-        self.kalm.statePost = np.array(_state, dtype=np.float32)
-
-    def predict(self):
-        state = self.kalm.predict()
-        #self.bbox = np.array(cen2cor(state[0], state[1], state[2], state[3]))
-        state = np.squeeze(state) # predict() returns an array of shape (8, 1)
-        self.state = np.array([state[0], state[1], state[2], state[3]])
-        return state
-
-    def correct(self, frame_id: int, measurement: np.ndarray[np.float32], mask: np.ndarray[Any, np.dtype[np.bool_]]):
-        """Correct the state with new measurement.
+        The correction itself is done by MOT. Unlike the former cv.KalmanFilter-based Blob, STATE
+        is not a measurement and is stored as is.
 
         Args:
-            measurement: [center_x, center_y, w, h] Measured state. When measurement is None, add
-                         an empty mask and contour.
+            state: (4,) [center_x, center_y, w, h] State already corrected by the Kalman filter
+                   with the new measurement. When state is None, add an empty mask and contour.
             mask: binary mask of the particle. Cannot be empty array.
         """
-        if measurement is None:
+        if state is None:
             # This blob is not detected in the latest frame. Temporarily keep it alive.
             # The mask must be non-empty for the first detected frame.
             img_height, img_width = self.masks[self.frames[0]].shape[-2:]
@@ -95,20 +94,14 @@ class Blob:
             self.contours[frame_id] = np.array([], dtype=np.int32).reshape([0, 1, 2]) # '0' for 0 particles
             return
 
-        # Correct bbox with the state updated by Kalman from both estimation and measurement.
-        self.kalm.correct(measurement)
-        state     = self.kalm.statePost
         #self.bbox = np.array(cen2cor(state[0], state[1], state[2], state[3]))
-        self.state = np.array([state[0], state[1], state[2], state[3]])
+        self.state = state
 
         # Note! The bbox might not enclose the mask since the bbox has been modified by the Kalman filter.
         self.masks[frame_id] = mask
         cnt, _img_height, _img_width, = mask_to_cnt(mask)
         self.contours[frame_id] = cnt
 
-    def statePost(self):
-        return self.kalm.statePost
-
     def get_bbox(self, frame_id = -1):
         """
         Get bbox from masks for the given frame. If frame_id is not given, return the bbox
@@ -141,6 +134,14 @@ class Blob:
             del self.contours[frame_id]
 
 class MOT:
+    """
+    Multi-object tracker. The Kalman filters of all tracked blobs are stored together, so that
+    a frame is predicted for all blobs at once.
+
+    Attributes:
+        X:  np.ndarray: (N, 8) Posterior states of the Kalman filters of self.blobs, in the same order.
+        P:  np.ndarray: (N, 8, 8) Posterior error covariances of the Kalman filters of self.blobs.
+    """
 
     # Number of frames allow for a blob to be undetected before dropping it from tracking.
     UNDETECTION_THRESHOLD = 2
@@ -161,14 +162,18 @@ class MOT:
         self.merge_it    = merge_it       # Iteration to operate the merge
         self.merge_th    = merge_th
 
+        self.X = np.empty((0, 8), dtype=np.float32)
+        self.P = np.empty((0, 8, 8), dtype=np.float32)
+
         # assign a blob for each box
+        new_blobs = []
         for i in range(self.blolen):
             # assign a blob for each bbox
             self.total_blobs += 1
             # b = Blob(self.total_blobs, bbox[i], mask[i])
             b = Blob(self.total_blobs, self.frame_id, states[i], mask[i])
-            self.blobs.append(b)
-            self.blobs_all.append(b)
+            new_blobs.append(b)
+        self.__addBlobs(new_blobs)
 
         # optional box merge
         # if merge:
@@ -201,8 +206,7 @@ class MOT:
         self.__delBlobs(ind_del)
 
         # Add new blobs
-        self.blobs += new_blobs
-        self.blobs_all += new_blobs
+        self.__addBlobs(new_blobs)
         self.total_blobs += len(new_blobs)
 
         # Optional merge
@@ -211,10 +215,28 @@ class MOT:
 
         self.blolen = len(self.blobs)
 
+    def __addBlobs(self, new_blobs):
+        """
+        Start tracking NEW_BLOBS. Their Kalman filters start from the detected state, with zero
+        velocities and zero error covariance.
+        """
+        if len(new_blobs) == 0:
+            return
+        X_new = np.zeros((len(new_blobs), 8), dtype=np.float32)
+        X_new[:, :4] = [b.state for b in new_blobs]
+        self.X = np.concatenate((self.X, X_new))
+        self.P = np.concatenate((self.P, np.zeros((len(new_blobs), 8, 8), dtype=np.float32)))
+        self.blobs += new_blobs
+        self.blobs_all += new_blobs
+
     def __pred(self):
-        # predict next position
+        # predict next position of all blobs at once. As cv.KalmanFilter, the prediction is
+        # also kept as the posterior until corrected.
+        self.X = self.X @ _F.T
+        self.P = _F @ self.P @ _F.T + _Q
+        states = self.X[:, :4].copy()
         for i in range(self.blolen):
-            self.blobs[i].predict()
+            self.blobs[i].state = states[i]
             self.blobs[i].frames.append(self.frame_id) # Even include the "dead" frames.
 
     def __hungarian(self, states):
@@ -222,7 +244,7 @@ class MOT:
         Return the ids of the existing blobs that matches the new bboxes in the new frame.
         """
 
-        cost = costMatrix(states, self.blobs, fixed_cost=self.fixed_cost)
+        cost = costMatrix(states, self.X[:, :4], fixed_cost=self.fixed_cost)
         # Default is to minimize the cost.
         box_ind, blob_ind = linear_sum_assignment(cost)
         return blob_ind
@@ -230,12 +252,18 @@ class MOT:
     def __update(self, states, blob_ind, mask):
         boxlen = len(states)
         new_blobs = []
+        # Correct bbox with the state updated by Kalman from both estimation and measurement.
+        # All detected blobs are corrected by one call into the compiled kernel.
+        #m   = np.array(cor2cen(bbox[i]), dtype=np.float32)
+        measurements = np.asarray(states, dtype=np.float32).reshape(-1, 4)
+        detected = np.flatnonzero(blob_ind[:boxlen] < self.blolen)
+        correct_states(self.X, self.P, blob_ind[detected], measurements[detected], _H, _R)
+        states_post = self.X[:, :4].copy()
+
         for i in range(boxlen):
-            #m   = np.array(cor2cen(bbox[i]), dtype=np.float32)
-            measurement = np.array(states[i], dtype=np.float32)
             ind = blob_ind[i]
             if ind < self.blolen:  # Case 1: Detected bbox match one of the existing blob.
-                self.blobs[ind].correct(self.frame_id, measurement, mask[i])
+                self.blobs[ind].correct(self.frame_id, states_post[ind], mask[i])
                 self.blobs[ind].dead = 0  # Recount the number of undetected frames.
             else:  # Case 2: Detected bbox don't match any of the existing blob.
                 # blob.idx starts from 1.
@@ -268,14 +296,15 @@ class MOT:
         return ind_del
 
     def __delBlobs(self, ind_del):
-        # sort first and then start removing from the end
-        ind_del.sort(reverse=True)
+        # Mark the blobs to drop and rebuild the list once, rather than popping them one by one.
+        keep = np.ones(len(self.blobs), dtype=bool)
         for ind in ind_del:
             self.blobs[ind].dead += 1
             if self.blobs[ind].dead > MOT.UNDETECTION_THRESHOLD:
                 # Keep trajectory alive for UNDETECTION_THRESHOLD to deal with flickering phenomenon.
                 #self.blobs_all.append(self.blobs[ind])
-                _blob = self.blobs.pop(ind)
+                keep[ind] = False
+                _blob = self.blobs[ind]
                 # Remove the last frame id from the frame list, so only two undetected frames
                 # can exist in the frame list.
                 _blob.delete_frame(self.frame_id)
@@ -286,6 +315,11 @@ class MOT:
                 for i in range(1, MOT.UNDETECTION_THRESHOLD + 1):
                     _blob.delete_frame(self.frame_id - i)
 
+        if not keep.all():
+            self.blobs = [b for b, k in zip(self.blobs, keep) if k]
+            self.X = self.X[keep]
+            self.P = self.P[keep]
+
     def __merge(self):
         """
         (Deprecated) A bbox merge strategy based on location and velocity information from Kalman Filters.
@@ -299,8 +333,8 @@ class MOT:
                 cursor_right = cursor_left + 1
                 while(cursor_right < length):
                     # Get posterior states
-                    state1    = self.blobs[cursor_left].statePost()
-                    state2    = self.blobs[cursor_right].statePost()
+                    state1    = self.X[cursor_left]
+                    state2    = self.X[cursor_right]
 
                     # parse state vectors
                     cenx1,ceny1,w1,h1,vx1,vy1,_,_ = state1
@@ -324,9 +358,13 @@ class MOT:
                         blob1 = self.blobs[cursor_left]
                         blob2 = self.blobs[cursor_right]
                         self.blobs[cursor_left]  = unionBlob(blob1, blob2)
+                        # Average posterior state
+                        self.X[cursor_left] = (state1 + state2) / 2.
 
                         # pop merged data from lists
                         self.blobs.pop(cursor_right)
+                        self.X = np.delete(self.X, cursor_right, axis=0)
+                        self.P = np.delete(self.P, cursor_right, axis=0)
                         length = length - 1 # adjust length of the list
                     else:
                         cursor_right = cursor_right + 1
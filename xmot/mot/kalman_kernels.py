@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Numba kernels of the linear Kalman filter tracking the blobs.
+
+They follow the update equations of cv.KalmanFilter without the overhead of calling into
+OpenCV for every blob at every frame. The matrices are small and of fixed size (8 states,
+4 measurements), so plain loops are compiled into unrolled and vectorized code. The time
+update is done for all blobs at once by MOT and doesn't need a kernel.
+"""
+
+import numpy as np
+from numba import njit
+
+@njit(cache=True, fastmath=True)
+def correct_state(x, P, z, H, R):
+    """
+    Measurement update of the Kalman filter.
+
+    Args:
+        x: (n,)   Predicted state.
+        P: (n, n) Predicted error covariance.
+        z: (m,)   Measurement.
+        H: (m, n) Measurement matrix.
+        R: (m, m) Measurement noise covariance.
+
+    Return:
+        np.ndarray: Corrected state, x + K (z - H x).
+        np.ndarray: Corrected error covariance, P - K H P.
+    """
+    m, n = H.shape
+    HP = np.zeros((m, n), dtype=P.dtype)
+    for i in range(m):
+        for k in range(n):
+            for j in range(n):
+                HP[i, j] += H[i, k] * P[k, j]
+
+    # Innovation covariance S = H P H^T + R and residual y = z - H x.
+    S = R.copy()
+    y = z.copy()
+    for i in range(m):
+        for k in range(n):
+            y[i] -= H[i, k] * x[k]
+            for j in range(m):
+                S[i, j] += HP[i, k] * H[j, k]
+
+    # Kalman gain K = P H^T S^-1. Since P and S are symmetric, K^T = S^-1 H P.
+    Kt = np.linalg.solve(S, HP)
+
+    x_corr = x.copy()
+    P_corr = P.copy()
+    for i in range(n):
+        for k in range(m):
+            x_corr[i] += Kt[k, i] * y[k]
+            for j in range(n):
+                P_corr[i, j] -= Kt[k, i] * HP[k, j]
+    return x_corr, P_corr
+
+@njit(cache=True, fastmath=True)
+def correct_states(X, P, inds, Z, H, R):
+    """
+    Measurement update of the Kalman filters of all blobs detected in a frame, in place.
+
+    Args:
+        X:    (N, n)    Predicted states of all tracked blobs. Rows in INDS are corrected.
+        P:    (N, n, n) Predicted error covariances of all tracked blobs.
+        inds: (K,)      Rows of the detected blobs.
+        Z:    (K, m)    Measurements of the detected blobs, in the same order as INDS.
+        H:    (m, n)    Measurement matrix.
+        R:    (m, m)    Measurement noise covariance.
+    """
+    for k in range(inds.shape[0]):
+        i = inds[k]
+        x, p = correct_state(X[i], P[i], Z[k], H, R)
+        X[i] = x
+        P[i] = p
+
+# Compile the kernels at import, so that the first frame isn't paused by the JIT. With
+# cache=True, the compiled code is saved next to this module and reused by later runs.
+correct_states(np.zeros((1, 8), dtype=np.float32), np.zeros((1, 8, 8), dtype=np.float32),
+               np.zeros(1, dtype=np.intp), np.zeros((1, 4), dtype=np.float32),
+               np.eye(4, 8, dtype=np.float32), np.eye(4, dtype=np.float32))
@@ -169,24 +169,32 @@ def cen2cor(cenx,ceny,w,h):
 
     return x1,y1,x2,y2
 
-def costMatrix(states, blobs, fixed_cost=80.):
+def costMatrix(states, blob_states, fixed_cost=80.):
+    """
+    Cost of assigning each detected particle to each tracked blob.
+
+    Args:
+        states:      (N, 4) [centroid_x, centroid_y, w, h] of the detected particles.
+        blob_states: (M, 4) [centroid_x, centroid_y, w, h] of the tracked blobs.
+        fixed_cost:  Cost of leaving a particle or a blob unassigned.
+    """
     boxlen = len(states)
-    blolen = len(blobs)
+    blolen = len(blob_states)
 
     # size of cost array twice the largest
     # that way every blob can be deleted and new bbox can be created
     length = 2*max(boxlen, blolen)
-    cost = np.ones((length, length), dtype=np.float64) * fixed_cost
+    cost = np.full((length, length), fixed_cost, dtype=np.float64)
+    if boxlen == 0 or blolen == 0:
+        return cost
 
-    # Calculate cost
-    for i in range(boxlen):
-        for j in range(blolen):
-            cenx1,ceny1,w1,h1 = states[i]
-            cenx2,ceny2,w2,h2 = blobs[j].state
+    # Calculate cost of all pairs at once: (N, 1, 4) - (1, M, 4)
+    diff = np.asarray(states, dtype=np.float64)[:, np.newaxis, :] \
+           - np.asarray(blob_states, dtype=np.float64)[np.newaxis, :, :]
 
-            # eucledian distance
-            cost[i][j] = np.sqrt( (cenx1 - cenx2)**2 + (ceny1 - ceny2)**2 ) \
-                         + abs(w1 - w2) + abs(h1 - h2)
+    # eucledian distance
+    cost[:boxlen, :blolen] = np.hypot(diff[..., 0], diff[..., 1]) \
+                             + np.abs(diff[..., 2]) + np.abs(diff[..., 3])
 
     return cost
 
@@ -261,11 +269,11 @@ def unionBlob(blob1, blob2):
     -------
     Main blob
     '''
-    # Average posteior state
-    blob1.kalm.statePost = (blob1.kalm.statePost + blob2.statePost())/2.
+    # Average state. The posterior state of the Kalman filter is averaged by MOT.
+    state       = (np.asarray(blob1.state) + np.asarray(blob2.state))/2.
+    blob1.state = state
 
     # update bbox
-    state      = blob1.kalm.statePost
     blob1.bbox = np.array(cen2cor(state[0],state[1],state[2],state[3]))
 
     # stub
@@ -6,9 +6,11 @@ import json
 from typing import Dict, List
 from xmot.digraph.parser import parse_pascal_xml
 from xmot.digraph.particle import Particle
-from xmot.config import AREA_THRESHOLD
+from xmot.config import AREA_THRESHOLD, IMAGE_FILE_PATTERN
 from typing import List, Tuple, Dict
 
+_IMAGE_FILE_RE = re.compile(IMAGE_FILE_PATTERN)
+
 def load_labels(data_dir, area_threshold=AREA_THRESHOLD) -> Tuple[Dict[int, Dict[int, List[int]]], Dict[int, Dict[int, np.ndarray]]]:
     """
     Return list of bboxes and images in labelled data in a nested dict. The outer dict uses
@@ -22,7 +24,7 @@ def load_labels(data_dir, area_threshold=AREA_THRESHOLD) -> Tuple[Dict[int, Dict
     images = {}
     for xml in xmls:
         particles, img_file_name = parse_pascal_xml(xml, area_threshold=area_threshold)
-        obj = re.match(".*_([0-9]+)_([a-zA-Z]*)([0-9]+)\.([a-zA-Z]+)", img_file_name)
+        obj = _IMAGE_FILE_RE.match(img_file_name)
         video_id = int(obj.group(1))
         image_id = int(obj.group(3)) # frame_id
         bbox = [p.get_contour_bbox_torch() for p in particles]
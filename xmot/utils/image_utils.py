@@ -2,13 +2,28 @@ import sys, os
 import cv2 as cv
 import numpy as np
 import natsort, re
-import math
 from pathlib import Path
-from scipy.stats import mode
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 
 from xmot.config import IMAGE_FORMAT, IMAGE_FILE_PATTERN
 
+_IMAGE_FILE_RE = re.compile(IMAGE_FILE_PATTERN)
+# Image file names without a video id.
+_SHORT_IMAGE_FILE_RE = re.compile(r".*_([a-zA-Z]*)([0-9]+)\.([a-zA-Z]+)")
+
+def _pixel_mode(img: np.ndarray, invert=False) -> np.uint8:
+    """
+    Most frequent pixel value of an 8-bit image, from its 256-bin histogram. Ties go to the
+    smallest value as scipy.stats.mode.
+
+    If INVERT, return the mode of the inverted image (255 - IMG) without inverting it.
+    """
+    hist = np.bincount(img.ravel(), minlength=256)
+    if invert:
+        hist = hist[::-1]
+    return np.uint8(hist.argmax())
+
 def subtract_brightfield_by_scaling(img_video, img_bf, scale = 0.8, shift_back=False):
     """
     Deprecated. Leave here as a record.
@@ -17,23 +32,22 @@ def subtract_brightfield_by_scaling(img_video, img_bf, scale = 0.8, shift_back=F
     """
     img_bf_invert = cv.bitwise_not(img_bf)
     img_video_invert = cv.bitwise_not(img_video)
-    bf_mode = mode(img_bf_invert, axis=None).mode
-    video_mode = mode(img_video_invert, axis=None).mode
+    bf_mode = _pixel_mode(img_bf_invert)
+    video_mode = _pixel_mode(img_video_invert)
     factor = scale * video_mode / bf_mode # Make the peak of histogram of the brightfield
                                           # 0.8 to that of the video.
     # Scaling the peak of the pixel distribution of the brightfield image relative to that
     # of the video image.
     img_bf_invert = np.array(img_bf_invert * factor, dtype=np.uint8)
 
-    # Taking care of the underflow problem of uint8.
-    img_inverted_subtract = np.subtract(img_video_invert, img_bf_invert)
-    img_inverted_subtract[img_bf_invert > img_video_invert] = 0
+    # cv.subtract saturates, which takes care of the underflow problem of uint8.
+    img_inverted_subtract = cv.subtract(img_video_invert, img_bf_invert)
 
     img_inverted_subtract = cv.bitwise_not(img_inverted_subtract) # Inverse back so particles are dark.
 
     if shift_back:
-        _mode_orig = mode(img_video, axis=None).mode
-        _mode_result = mode(img_inverted_subtract, axis=None).mode
+        _mode_orig = _pixel_mode(img_video)
+        _mode_result = _pixel_mode(img_inverted_subtract)
         img_inverted_subtract = img_inverted_subtract - (_mode_result - _mode_orig)
 
     return img_inverted_subtract, img_video_invert, img_bf_invert, bf_mode, video_mode, factor
@@ -44,31 +58,41 @@ def subtract_brightfield_by_shifting(img_video: np.ndarray, img_bf: np.ndarray,
 
     This function shifts the brightfield image rather than scaling it by multiple a factor so that
     the shape of the pixel distribution is preserved.
+
+    The subtraction is done on the inverted images so that particles are bright, and inverted back
+    afterwards. Since 255 - max(0, (255 - video) - bf_shifted) = min(255, video + bf_shifted), it
+    is evaluated as a saturated addition without inverting any image.
+
+    Return:
+        np.ndarray: The subtracted image.
+        None:       Formerly the inverted video image, which is no longer computed. Kept so that
+                    the number of returned values doesn't change.
+        np.ndarray: The inverted brightfield image after shifting.
+        np.uint8:   Mode of the inverted brightfield image.
+        np.uint8:   Mode of the inverted video image.
+        float:      The shift applied to the inverted brightfield image.
     """
-    img_bf_invert = cv.bitwise_not(img_bf)
-    img_video_invert = cv.bitwise_not(img_video)
-    bf_invert_mode = mode(img_bf_invert, axis=None).mode
-    video_invert_mode = mode(img_video_invert, axis=None).mode
+    bf_invert_mode = _pixel_mode(img_bf, invert=True)
+    video_invert_mode = _pixel_mode(img_video, invert=True)
 
     # Shfit the peak of the pixel distribution of bf image to align with that of the video.
+    # (255 - img_bf) - shift == (255 - shift) - img_bf. cv.subtract saturates, which takes care
+    # of the underflow problem of uint8. Flooring the scalar truncates like the cast to uint8.
     shift = bf_invert_mode - scale * video_invert_mode
-    img_bf_invert_shifted = np.array(img_bf_invert - shift, dtype=np.uint8)
-    img_bf_invert_shifted[img_bf_invert < shift] = 0 # Taking care of the underflow problem of uint8.
+    img_bf_invert_shifted = cv.subtract(float(np.floor(255 - shift)), img_bf)
 
-    img_inverted_subtract = np.subtract(img_video_invert, img_bf_invert_shifted)
-    img_inverted_subtract[img_video_invert < img_bf_invert_shifted] = 0
-
-    img_result = cv.bitwise_not(img_inverted_subtract) # Inverse back so particles are dark.
+    # cv.add saturates, which takes care of the overflow problem of uint8.
+    img_result = cv.add(img_video, img_bf_invert_shifted) # Particles stay dark.
 
     if shift_back:
         # Shift the pixel distribution of image back to the original peak.
-        _video_mode = mode(img_result, axis=None).mode # likely a large value close to 256.
-        _orig_video_mode = mode(img_video, axis=None).mode
+        _video_mode = _pixel_mode(img_result) # likely a large value close to 256.
+        _orig_video_mode = _pixel_mode(img_video)
         _shift = _video_mode - _orig_video_mode
         # Recover the original background pixel value by subtracting a constant value
         img_result = img_result - _shift
 
-    return img_result, img_video_invert, img_bf_invert_shifted, bf_invert_mode, video_invert_mode, shift
+    return img_result, None, img_bf_invert_shifted, bf_invert_mode, video_invert_mode, shift
 
 def subtract_brightfield(orig_images: List[np.ndarray], image_brightfield: np.ndarray) -> List[np.ndarray]:
     """A wrapper function of subtract_brightfield_by_shifting() to operate on multiple images.
@@ -111,33 +135,37 @@ def load_images_from_dir(dir, start_id=0, end_id=sys.maxsize, ext=None, grayscal
 
     TODO: Refactor to use imageio.get_reader(). Don't reinvent wheel.
     """
+    # DirEntry caches the file type from reading the directory, so no stat() per file is needed.
+    with os.scandir(dir) as it:
+        entries = [e for e in it if e.is_file()]
     if ext is None:
-        files = [os.path.join(dir, f) for f in os.listdir(dir)]
-        files = [f for f in files if os.path.isfile(f)]
-        for f in files:
-            if f.split(".")[-1] in IMAGE_FORMAT:
-                ext = f.split(".")[-1]
+        for e in entries:
+            if e.name.split(".")[-1] in IMAGE_FORMAT:
+                ext = e.name.split(".")[-1]
                 break
-        files = [f for f in files if f.endswith(ext)]
-    else:
-        files = [f for f in os.listdir(dir) if f.endswith(ext)]
+    files = [e.path for e in entries if ext is not None and e.name.endswith(ext)]
+
+    if len(files) == 0:
+        print(f"No valid image files found in {dir} with extension {ext}")
+        return [], []
 
     files = natsort.natsorted(files)
     #files.sort(key=lambda f: int(re.match(".*_([a-zA-Z]*)([0-9]+)\.([a-z]+)", f).group(2)))
-    if re.match(IMAGE_FILE_PATTERN, files[0]) is not None:
-        files = [f for f in files if start_id <= int(re.match(IMAGE_FILE_PATTERN, f).group(3)) <= end_id]
+    if _IMAGE_FILE_RE.match(files[0]) is not None:
+        files = [f for f in files if start_id <= int(_IMAGE_FILE_RE.match(f).group(3)) <= end_id]
     else:
         # The images might not contain a video id. Use a shorter regular expression.
-        files = [f for f in files if start_id <= int(re.match(".*_([a-zA-Z]*)([0-9]+)\.([a-zA-Z]+)", f).group(2)) <= end_id]
-
+        files = [f for f in files if start_id <= int(_SHORT_IMAGE_FILE_RE.match(f).group(2)) <= end_id]
 
     if len(files) == 0:
         print(f"No valid image files found in {dir} with extension {ext}")
 
-    if grayscale:
-        orig_images = [cv.imread(f, cv.IMREAD_GRAYSCALE) for f in files]
-    else:
-        orig_images = [cv.imread(f) for f in files]  # color pics are already in BGR order, not RBG
+    # color pics are already in BGR order, not RBG
+    flag = cv.IMREAD_GRAYSCALE if grayscale else cv.IMREAD_COLOR
+    # cv.imread releases the GIL while decoding, so the images are decoded in parallel.
+    # map() keeps the order of the files.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        orig_images = list(executor.map(lambda f: cv.imread(f, flag), files))
     orig_image_names = [Path(f).resolve().name for f in files]
     return orig_images, orig_image_names
 
@@ -146,20 +174,14 @@ def combine_images(n_row, n_column, images):
     Paste a list of images into a panel of n_row * n_column. Assume all images in the list
     share the same size of the first image of the list.
     """
-    if len(images[0].shape) == 3:
-        h0, w0, n_color = images[0].shape
-        img_combined = np.zeros((h0 * n_row, w0 * n_column, n_color), np.uint8)
-    elif len(images[0].shape) == 2:
-        h0, w0 = images[0].shape
-        img_combined = np.zeros((h0 * n_row, w0 * n_column), np.uint8)
+    h0, w0, *n_color = images[0].shape
+    img_combined = np.zeros((h0 * n_row, w0 * n_column, *n_color), np.uint8)
 
+    # View the panel as (n_row, h0, n_column, w0) so that each tile is addressed by its row and
+    # column. Each image is copied once straight into the panel.
+    tiles = img_combined.reshape(n_row, h0, n_column, w0, *n_color)
     for i in range(0, len(images)):
-        img  = images[i]
-        row = math.floor(i / n_column)
-        column = i % n_column
-        if len(images[0].shape) == 3:
-            img_combined[(h0*row):(h0*(row+1)), (w0*column):(w0*(column+1)), :] = img
-        else:
-            img_combined[(h0*row):(h0*(row+1)), (w0*column):(w0*(column+1))] = img
+        row, column = divmod(i, n_column)
+        tiles[row, :, column] = images[i]
 
     return img_combined
\ No newline at end of file